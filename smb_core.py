@@ -0,0 +1,2426 @@
+# Author: Sean
+# Email: fishis@126.com
+
+# SMB engine shared by the desktop client and the headless watcher.
+# Nothing here may import tkinter, pystray or PIL at module level.
+
+import abc
+import threading
+import queue
+import collections
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import io
+from smb.SMBConnection import SMBConnection
+from smb.base import NotConnectedError, SMBTimeout
+import socket
+import os
+import signal
+import shutil
+import time
+import datetime
+import hashlib
+import sqlite3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+
+import sys
+
+import json
+
+# Settings and caches live in the user's home directory
+CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".yunkai_smb_client")
+CONFIG_FILE_NAME = "config.json"
+
+# Metrics export, the file is rewritten periodically and the HTTP endpoint is off unless a port is set
+METRICS_FILE_NAME = "metrics.prom"
+
+# Watch jobs: the scheduler wakes at least this often to pick up config changes
+SCHEDULER_TICK = 5
+MAX_WATCH_JOBS = 8
+# Files transferred at once across all watch jobs
+DEFAULT_AUTO_MAX_TRANSFERS = 2
+# Adaptive polling: fast right after new files, doubling toward the maximum while a folder stays idle
+DEFAULT_POLL_MIN_INTERVAL = 5
+DEFAULT_POLL_MAX_INTERVAL = 300
+# A file is only downloaded once size and last-write time were identical in this many listings
+DEFAULT_SETTLE_OBSERVATIONS = 2
+# Post-download processing, queued files beyond POST_MAX_PENDING make the downloader wait
+DEFAULT_POST_WORKERS = 2
+POST_MAX_PENDING = 8
+WATCH_JOB_DEFAULTS = {"name": "", "server": "", "source_path": "", "local_path": "", "interval": 60, "enabled": True}
+
+# Host name and NetBIOS lookups are cached next to config.json
+RESOLVE_CACHE_NAME = "resolve_cache.json"
+DNS_TTL = 3600
+NETBIOS_TTL = 24 * 3600
+# Failed lookups are remembered too, so a blocked UDP 137 isn't waited on every connect
+NEGATIVE_TTL = 600
+METRICS_WRITE_INTERVAL = 15
+
+# connect() races port/name candidates, the next one starts after this delay or as soon as one fails
+CONNECT_STAGGER = 0.3
+# Head start given to the combination that last worked for a host before the others join
+CONNECT_HINT_HEAD_START = 2.0
+
+# Default number of parallel SMB sessions used for batch transfers
+DEFAULT_TRANSFER_WORKERS = 4
+# Pooled sessions idle longer than this are probed with an echo before reuse, servers drop idle sessions
+POOL_PROBE_AFTER = 30
+
+# Suffix of in-progress downloads, kept next to the target so they can be resumed
+PARTIAL_SUFFIX = ".part"
+
+# Local writes: buffered in large blocks, fsynced and the written offset recorded every checkpoint
+DEFAULT_WRITE_BUFFER_KB = 1024
+SINK_CHECKPOINT_BYTES = 8 * 1024 * 1024
+
+# Downloads are hashed while they are written; the digest feeds the local dedup index
+CONTENT_HASH = "sha256"
+HASH_CHUNK = 1024 * 1024
+# dedup_mode: "off" stores every copy, "hardlink" links a duplicate to the existing file, "skip" drops it
+CONTENT_INDEX_NAME = "content_index.db"
+
+# Files at least this large are fetched as parallel byte ranges (0 disables)
+DEFAULT_STRIPE_THRESHOLD_MB = 64
+STRIPE_SIZE = 16 * 1024 * 1024
+
+# Folder listings are served from cache while fresh, and served stale (then
+# revalidated in the background) until they expire
+LISTING_TTL = 15
+LISTING_STALE_TTL = 300
+LISTING_CACHE_SIZE = 256
+LISTING_PREFETCH_DIRS = 8
+
+# Rows inserted into the file list per event-loop tick
+FILE_LIST_CHUNK = 300
+
+# Parallel sessions used by the search index crawler
+INDEX_WORKERS = 2
+
+# Preview cache limits
+DEFAULT_PREVIEW_CACHE_MB = 512
+PREVIEW_CACHE_MAX_AGE_DAYS = 7
+
+# Thumbnails for the file list
+THUMBNAIL_SIZE = 48
+THUMBNAIL_EXTENSIONS = (".jpg", ".jpeg", ".tif", ".tiff", ".png", ".bmp", ".pdf")
+THUMBNAIL_HEADER_BYTES = 256 * 1024
+THUMBNAIL_PDF_HEADER_BYTES = 4 * 1024 * 1024
+THUMBNAIL_MAX_FULL_FETCH = 32 * 1024 * 1024
+
+
+class Timing:
+    """ Handle yielded by Metrics.timer, set `bytes` to record a transfer """
+    def __init__(self):
+        self.bytes = 0
+
+
+class Metrics:
+    """ In-process counters and histograms, rendered in Prometheus text format """
+
+    DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 for n in range(6, 18, 2))  # 64 KB/s .. 64 MB/s
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist["counts"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    @contextlib.contextmanager
+    def timer(self, op, **labels):
+        timing = Timing()
+        start = time.perf_counter()
+        try:
+            yield timing
+        except Exception:
+            self.inc("smb_errors_total", op=op, **labels)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.inc("smb_ops_total", op=op, **labels)
+            self.observe("smb_op_duration_seconds", elapsed, self.DURATION_BUCKETS, op=op, **labels)
+            if timing.bytes:
+                self.inc("smb_bytes_total", timing.bytes, op=op, **labels)
+                if elapsed > 0:
+                    self.observe("smb_throughput_bytes_per_second", timing.bytes / elapsed,
+                                 self.THROUGHPUT_BUCKETS, op=op, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        # Exposition format: backslash, double quote and newline are escaped inside label values
+        escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = []
+        with self.lock:
+            last = None
+            for (name, labels), value in sorted(self.counters.items()):
+                if name != last:
+                    lines.append(f"# TYPE {name} counter")
+                    last = name
+                lines.append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name != last:
+                    lines.append(f"# TYPE {name} histogram")
+                    last = name
+                for bound, count in zip(hist["buckets"], hist["counts"]):
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{self._labels(labels)} {hist['sum']:.6f}")
+                lines.append(f"{name}_count{self._labels(labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """ Writes METRICS to a .prom file periodically and optionally serves it on localhost """
+
+    def __init__(self, metrics, path, port=0):
+        self.metrics = metrics
+        self.path = path
+        self.port = port
+        self.server = None
+
+    def start(self):
+        threading.Thread(target=self._write_loop, daemon=True).start()
+        if self.port:
+            metrics = self.metrics
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            try:
+                # Loopback only, this is for local scrapers and support staff
+                self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+                threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            except OSError as e:
+                print(f"Metrics endpoint on port {self.port} failed: {e}")
+
+    def write(self):
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.metrics.render())
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Failed to write metrics: {e}")
+
+    def _write_loop(self):
+        while True:
+            time.sleep(METRICS_WRITE_INTERVAL)
+            self.write()
+
+
+METRICS = Metrics()
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+
+class TransferProgress:
+    """ Byte counters for one file or batch transfer, read by the UI at a fixed refresh rate """
+
+    def __init__(self, items_total=1):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.items_total = items_total
+        self.items_done = 0
+        self.expected_bytes = 0
+        self.done_bytes = 0
+        # Bytes that were already on disk (resumed), excluded from the rate
+        self.skipped_bytes = 0
+        # remote path -> [bytes done, size, start time]
+        self.active = {}
+        self.finished = False
+
+    def expect(self, nbytes):
+        with self.lock:
+            self.expected_bytes += nbytes
+
+    def start_file(self, name, size, offset=0):
+        with self.lock:
+            self.active[name] = [offset, size, time.monotonic()]
+            self.done_bytes += offset
+            self.skipped_bytes += offset
+
+    def add(self, name, nbytes):
+        with self.lock:
+            self.done_bytes += nbytes
+            entry = self.active.get(name)
+            if entry:
+                entry[0] += nbytes
+
+    def end_file(self, name):
+        with self.lock:
+            self.active.pop(name, None)
+
+    def item_done(self):
+        with self.lock:
+            self.items_done += 1
+
+    def percent(self):
+        with self.lock:
+            if not self.expected_bytes:
+                return 0
+            return min(100, self.done_bytes * 100 / self.expected_bytes)
+
+    def status_text(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started, 0.001)
+            rate = (self.done_bytes - self.skipped_bytes) / elapsed
+            parts = []
+            if self.active:
+                name, (done, size, _) = max(self.active.items(), key=lambda kv: kv[1][2])
+                pct = done * 100 / size if size else 100
+                parts.append(f"正在下载 {os.path.basename(name)} {pct:.0f}%")
+                if len(self.active) > 1:
+                    parts.append(f"另有 {len(self.active) - 1} 个并行")
+            else:
+                parts.append("正在下载")
+            if self.items_total > 1:
+                parts.append(f"{self.items_done}/{self.items_total} 项")
+            total = max(self.expected_bytes, self.done_bytes)
+            parts.append(f"{format_bytes(self.done_bytes)}/{format_bytes(total)}")
+            parts.append(f"{format_bytes(rate)}/s")
+            if rate > 0 and total > self.done_bytes:
+                parts.append(f"剩余 {format_eta((total - self.done_bytes) / rate)}")
+            return " | ".join(parts)
+
+
+class ProgressWriter:
+    """ File wrapper handed to retrieveFile, counting bytes as pysmb writes them """
+
+    def __init__(self, file_obj, progress, name):
+        self.file_obj = file_obj
+        self.progress = progress
+        self.name = name
+
+    def write(self, data):
+        n = self.file_obj.write(data)
+        self.progress.add(self.name, len(data))
+        return n
+
+
+class LocalSink:
+    """ Download target written through a preallocated temp file next to it, renamed into place only on commit """
+
+    def __init__(self, save_path, buffer_size=DEFAULT_WRITE_BUFFER_KB * 1024):
+        self.save_path = save_path
+        self.part_path = save_path + PARTIAL_SUFFIX
+        self.buffer_size = buffer_size
+        self.f = None
+        self.position = 0
+        self.unsynced = 0
+        self.on_checkpoint = None
+
+    def preallocate(self, size):
+        # Reserve the whole file up front so large downloads don't grow by many small extents
+        with open(self.part_path, 'r+b' if os.path.exists(self.part_path) else 'wb') as f:
+            f.truncate(size)
+            if size and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except OSError:
+                    pass # e.g. a filesystem without fallocate, the sparse file still works
+
+    def open(self, offset=0):
+        """ A buffered handle positioned at `offset`, for callers that manage their own ranges """
+        f = open(self.part_path, 'r+b', buffering=self.buffer_size)
+        f.seek(offset)
+        return f
+
+    @staticmethod
+    def sync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def begin(self, offset=0, on_checkpoint=None):
+        """ Sequential mode: write() appends from `offset`, on_checkpoint(position) runs once data is durable """
+        self.f = self.open(offset)
+        self.position = offset
+        self.unsynced = 0
+        self.on_checkpoint = on_checkpoint
+
+    def write(self, data):
+        n = self.f.write(data)
+        self.position += len(data)
+        self.unsynced += len(data)
+        if self.unsynced >= SINK_CHECKPOINT_BYTES:
+            self.checkpoint()
+        return n
+
+    def checkpoint(self):
+        self.sync(self.f)
+        self.unsynced = 0
+        if self.on_checkpoint:
+            self.on_checkpoint(self.position)
+
+    def close(self):
+        # Also runs after a failed transfer, so the progress so far is kept for a resume
+        if self.f:
+            try:
+                self.checkpoint()
+            finally:
+                self.f.close()
+                self.f = None
+
+    def commit(self):
+        os.replace(self.part_path, self.save_path)
+        if hasattr(os, "O_DIRECTORY"):
+            # Make the rename itself durable
+            try:
+                fd = os.open(os.path.dirname(os.path.abspath(self.save_path)), os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+
+
+class DownloadVerifyError(Exception):
+    """ The transferred byte count didn't match the listing; deliberately not an OSError, the session is fine """
+
+
+class HashingWriter:
+    """ File wrapper that hashes and counts bytes in the same pass as the download writes them """
+
+    def __init__(self, file_obj, hasher):
+        self.file_obj = file_obj
+        self.hasher = hasher
+        self.bytes = 0
+
+    def write(self, data):
+        n = self.file_obj.write(data)
+        self.hasher.update(data)
+        self.bytes += len(data)
+        return n
+
+
+def hash_file(path, hasher, length=None):
+    """ Feed the first `length` bytes (default all) of a local file into `hasher` """
+    remaining = os.path.getsize(path) if length is None else length
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(HASH_CHUNK, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    return hasher
+
+
+def open_smb_connection(params, timeout=5):
+    """ Open a new session using the port/remote name negotiated by connect() """
+    conn = SMBConnection(
+        params["user"],
+        params["password"],
+        params["client_name"],
+        params["remote_name"],
+        use_ntlm_v2=True,
+        sign_options=2,
+        is_direct_tcp=(params["port"] == 445)
+    )
+    with METRICS.timer("connect", port=params["port"]):
+        connected = conn.connect(params["ip"], params["port"], timeout=timeout)
+    if not connected:
+        METRICS.inc("smb_errors_total", op="connect", port=params["port"])
+        conn.close()
+        raise ConnectionError(f"认证失败 ({params['ip']}:{params['port']})")
+    return conn
+
+
+class ConnectionRace:
+    """ Happy-eyeballs style connect: staggered concurrent attempts, the first session wins """
+
+    def __init__(self, params, timeout=5, on_attempt=None):
+        self.params = params
+        self.timeout = timeout
+        self.on_attempt = on_attempt
+        self.cond = threading.Condition()
+        self.pending = collections.deque()
+        self.running = 0
+        self.closed = False
+        self.next_start = 0
+        self.winner = None
+        self.errors = {}
+
+    def add(self, port, remote_name, hold=CONNECT_STAGGER):
+        """ Queue a candidate, `hold` is how long it runs alone before the next one is started """
+        with self.cond:
+            if any(c[:2] == (port, remote_name) for c in self.pending):
+                return
+            self.pending.append((port, remote_name, hold))
+            self.cond.notify_all()
+
+    def close_input(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def _attempt(self, port, remote_name):
+        params = dict(self.params, port=port, remote_name=remote_name)
+        try:
+            conn = open_smb_connection(params, timeout=self.timeout)
+        except Exception as e:
+            with self.cond:
+                self.errors[f"{port}-{remote_name}"] = str(e)
+                self.running -= 1
+                # A failure lets the next candidate start right away
+                self.next_start = 0
+                self.cond.notify_all()
+            print(f"Failed on port {port} name {remote_name}: {e}")
+            return
+        with self.cond:
+            self.running -= 1
+            if self.winner is None:
+                self.winner = (conn, params)
+                self.cond.notify_all()
+                return
+        # Lost the race
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def run(self):
+        """ Returns (conn, params) of the first successful attempt, raises ConnectionError when all failed """
+        with self.cond:
+            while self.winner is None:
+                now = time.monotonic()
+                if self.pending and (self.running == 0 or now >= self.next_start):
+                    port, remote_name, hold = self.pending.popleft()
+                    self.running += 1
+                    self.next_start = now + hold
+                    if self.on_attempt:
+                        self.on_attempt(port, remote_name)
+                    threading.Thread(target=self._attempt, args=(port, remote_name), daemon=True).start()
+                    continue
+                if not self.pending and self.running == 0 and self.closed:
+                    break
+                self.cond.wait(max(self.next_start - now, 0.01) if self.pending else None)
+            if self.winner is None:
+                raise ConnectionError("所有连接尝试均失败")
+            # Attempts still in flight close their sessions when they finish
+            self.pending.clear()
+            return self.winner
+
+
+def retrieve_file_resumable(conn, share, remote_path, save_path, remote_file=None, progress=None,
+                            buffer_size=DEFAULT_WRITE_BUFFER_KB * 1024, mode=None):
+    """ Download through a preallocated sidecar .part file, continuing from the offset recorded in its
+    metadata if the remote file is unchanged. Returns the content digest, raises DownloadVerifyError
+    when the byte count doesn't match the listed size """
+    if remote_file is None:
+        remote_file = conn.getAttributes(share, remote_path)
+    size = remote_file.file_size
+    mtime = remote_file.last_write_time
+
+    sink = LocalSink(save_path, buffer_size)
+    meta_path = sink.part_path + ".json"
+    meta = {"remote_path": remote_path, "size": size, "last_write_time": mtime}
+
+    def write_meta(written):
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(meta, written=written), f, ensure_ascii=False)
+
+    offset = 0
+    if os.path.exists(sink.part_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                old = json.load(f)
+            local_size = os.path.getsize(sink.part_path)
+            # Striped part files track ranges instead of a single offset
+            if old.get("size") == size and old.get("last_write_time") == mtime and local_size <= size \
+                    and "stripe_size" not in old:
+                # The part file is preallocated, only the recorded offset is known to be on disk.
+                # Part files from before preallocation have no offset, their length is the progress.
+                offset = min(old.get("written", local_size), local_size)
+        except Exception as e:
+            print(f"Ignoring partial download {sink.part_path}: {e}")
+
+    if offset == 0:
+        # Record what we're downloading before the first byte lands
+        write_meta(0)
+    else:
+        print(f"Resuming {remote_path} at {offset}/{size} bytes")
+    sink.preallocate(size)
+
+    # Only a resumed prefix is read back, fresh downloads are hashed as they stream in
+    hasher = hash_file(sink.part_path, hashlib.new(CONTENT_HASH), offset) if offset else hashlib.new(CONTENT_HASH)
+    if progress:
+        progress.start_file(remote_path, size, offset)
+    sink.begin(offset, write_meta)
+    try:
+        writer = HashingWriter(sink, hasher)
+        f = ProgressWriter(writer, progress, remote_path) if progress else writer
+        if offset < size or size == 0:
+            with METRICS.timer("retrieveFile", **({"mode": mode} if mode else {})) as t:
+                _, t.bytes = conn.retrieveFileFromOffset(share, remote_path, f, offset=offset)
+    finally:
+        sink.close()
+        if progress:
+            progress.end_file(remote_path)
+
+    if offset + writer.bytes != size:
+        METRICS.inc("download_verify_failures_total")
+        raise DownloadVerifyError(f"下载大小不符 {remote_path}: {offset + writer.bytes}/{size} 字节")
+
+    sink.commit()
+    try:
+        os.remove(meta_path)
+    except OSError:
+        pass
+    return hasher.hexdigest()
+
+
+def retrieve_file_striped(conn, pool, share, remote_path, save_path, remote_file, stripe_size=STRIPE_SIZE, progress=None,
+                          buffer_size=DEFAULT_WRITE_BUFFER_KB * 1024):
+    """ Fetch byte ranges in parallel over pooled sessions into a preallocated .part file, returns the content digest """
+    size = remote_file.file_size
+    mtime = remote_file.last_write_time
+    sink = LocalSink(save_path, buffer_size)
+    part_path = sink.part_path
+    meta_path = part_path + ".json"
+
+    stripes = [(offset, min(stripe_size, size - offset)) for offset in range(0, size, stripe_size)]
+    done = set()
+    if os.path.exists(part_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get("size") == size and meta.get("last_write_time") == mtime \
+                    and meta.get("stripe_size") == stripe_size and os.path.getsize(part_path) == size:
+                done = set(meta.get("done", []))
+        except Exception as e:
+            print(f"Ignoring partial download {part_path}: {e}")
+
+    meta = {"remote_path": remote_path, "size": size, "last_write_time": mtime, "stripe_size": stripe_size}
+    downloader = StripeDownloader(conn, pool, share, remote_path, sink, meta_path, meta, done, progress)
+    if done:
+        print(f"Resuming {remote_path}: {len(done)}/{len(stripes)} ranges already done")
+    else:
+        downloader.write_meta()
+        # Preallocate so every range can be written in place
+        sink.preallocate(size)
+
+    if progress:
+        progress.start_file(remote_path, size, sum(stripes[i][1] for i in done))
+    try:
+        downloader.run(stripes)
+    finally:
+        if progress:
+            progress.end_file(remote_path)
+
+    if len(done) != len(stripes):
+        raise IOError(f"分段下载不完整: {len(done)}/{len(stripes)}")
+
+    # Ranges land out of order, so the digest needs one sequential read of the finished file
+    digest = hash_file(part_path, hashlib.new(CONTENT_HASH), size).hexdigest()
+    sink.commit()
+    try:
+        os.remove(meta_path)
+    except OSError:
+        pass
+    return digest
+
+
+class PooledTaskRunner(abc.ABC):
+    """ Run queued tasks on the caller's connection plus any idle pooled sessions """
+
+    def __init__(self, conn, pool, max_workers=None):
+        self.conn = conn
+        self.pool = pool
+        self.max_workers = max_workers or (pool.max_size if pool else 1)
+        self.tasks = []
+        self.outstanding = 0
+        self.errors = []
+        self.cond = threading.Condition()
+
+    def run(self):
+        helpers = [threading.Thread(target=self._helper, daemon=True) for _ in range(self.max_workers - 1)] if self.pool else []
+        for t in helpers:
+            t.start()
+        try:
+            self._work(self.conn)
+        finally:
+            for t in helpers:
+                t.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def submit(self, task):
+        with self.cond:
+            self.outstanding += 1
+            # LIFO keeps tree walks depth-first, so the frontier stays small
+            self.tasks.append(task)
+            self.cond.notify()
+
+    def pop_task(self):
+        # Called with self.cond held, returns None if nothing is runnable yet
+        return self.tasks.pop() if self.tasks else None
+
+    @abc.abstractmethod
+    def process(self, conn, task):
+        """ Run one task on `conn`, may submit more """
+
+    def retry(self, conn, task, error):
+        """ Return True after handing `task` back to the queue, so `error` only ends this worker """
+        return False
+
+    def _next_task(self):
+        with self.cond:
+            while True:
+                if self.errors or self.outstanding == 0:
+                    return None
+                task = self.pop_task()
+                if task is not None:
+                    return task
+                # Everything left is in flight on other workers
+                self.cond.wait(0.5)
+
+    def _work(self, conn):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return None
+            try:
+                self.process(conn, task)
+            except Exception as e:
+                print(f"Task {task[:2]} failed: {e}")
+                if not self.retry(conn, task, e):
+                    with self.cond:
+                        self.errors.append(e)
+                return e
+            finally:
+                with self.cond:
+                    self.outstanding -= 1
+                    self.cond.notify_all()
+
+    def _helper(self):
+        # Only borrow idle sessions, the caller's own connection guarantees progress
+        conn = self.pool.try_acquire()
+        if conn is None:
+            return
+        error = None
+        try:
+            error = self._work(conn)
+        finally:
+            self.pool.release(conn, isinstance(error, (NotConnectedError, SMBTimeout, OSError)))
+
+
+class StripeDownloader(PooledTaskRunner):
+    """ Download the byte ranges of one file in place, recording finished ranges in the .part metadata """
+
+    def __init__(self, conn, pool, share, remote_path, sink, meta_path, meta, done, progress=None):
+        super().__init__(conn, pool)
+        self.share = share
+        self.remote_path = remote_path
+        self.sink = sink
+        self.meta_path = meta_path
+        self.meta = meta
+        self.done = done
+        self.progress = progress
+        self.meta_lock = threading.Lock()
+        # One handle per session, ranges are written at their offset via seek
+        self.local = threading.local()
+        self.handles = []
+
+    def run(self, stripes):
+        # Submitted backwards so the LIFO queue hands out ranges front to back
+        for index in reversed(range(len(stripes))):
+            if index not in self.done:
+                self.submit(("range", stripes[index][0], stripes[index][1], index))
+        try:
+            super().run()
+        finally:
+            for f in self.handles:
+                f.close()
+
+    def write_meta(self):
+        with open(self.meta_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(self.meta, done=sorted(self.done)), f, ensure_ascii=False)
+
+    def process(self, conn, task):
+        _, offset, length, index = task
+        f = getattr(self.local, "f", None)
+        if f is None:
+            f = self.local.f = self.sink.open()
+            with self.meta_lock:
+                self.handles.append(f)
+        f.seek(offset)
+        writer = ProgressWriter(f, self.progress, self.remote_path) if self.progress else f
+        with METRICS.timer("retrieveFile", mode="striped") as t:
+            _, t.bytes = conn.retrieveFileFromOffset(self.share, self.remote_path, writer, offset=offset, max_length=length)
+        if t.bytes != length:
+            METRICS.inc("download_verify_failures_total")
+            raise DownloadVerifyError(f"分段大小不符 {self.remote_path} @{offset}: {t.bytes}/{length} 字节")
+        # A range is only marked done once it is on disk
+        self.sink.sync(f)
+        with self.meta_lock:
+            self.done.add(index)
+            self.write_meta()
+
+    def retry(self, conn, task, error):
+        # A failed helper gives its range back, the caller's connection picks it up
+        if conn is self.conn:
+            return False
+        self.submit(task)
+        return True
+
+
+class TreeDownloader(PooledTaskRunner):
+    """ Walk a remote folder with parallel listings, downloading files while the walk continues """
+
+    def __init__(self, conn, pool, share, download_file, prefetch_files=32, progress=None):
+        super().__init__(conn, pool)
+        self.share = share
+        self.download_file = download_file
+        self.progress = progress
+        # Listing only runs ahead while fewer than this many files are waiting,
+        # which keeps memory flat on very deep or wide trees
+        self.prefetch_files = prefetch_files
+        self.files = collections.deque()
+
+    def run(self, remote_root, local_root):
+        self.submit(("dir", remote_root, local_root))
+        super().run()
+
+    def pop_task(self):
+        if self.tasks and len(self.files) < self.prefetch_files:
+            return self.tasks.pop()
+        if self.files:
+            return self.files.popleft()
+        return None
+
+    def process(self, conn, task):
+        if task[0] == "dir":
+            self._list_dir(conn, task[1], task[2])
+        else:
+            self.download_file(conn, self.share, *task[1:], progress=self.progress)
+
+    def _list_dir(self, conn, remote_path, local_path):
+        if not os.path.exists(local_path):
+            os.makedirs(local_path, exist_ok=True)
+        with METRICS.timer("listPath"):
+            items = conn.listPath(self.share, remote_path)
+        for item in items:
+            if item.filename in ['.', '..']:
+                continue
+            remote_item_path = os.path.join(remote_path, item.filename).replace('\\', '/')
+            local_item_path = os.path.join(local_path, item.filename)
+            if item.isDirectory:
+                self.submit(("dir", remote_item_path, local_item_path))
+            else:
+                if self.progress:
+                    self.progress.expect(item.file_size)
+                with self.cond:
+                    self.outstanding += 1
+                    self.files.append(("file", remote_item_path, local_item_path, item))
+                    self.cond.notify()
+
+
+class TreeDeleter(PooledTaskRunner):
+    """ Delete a remote folder: wildcard file deletes per folder, sibling subtrees in parallel, folders bottom-up """
+
+    def __init__(self, conn, pool, share, on_progress=None):
+        super().__init__(conn, pool)
+        self.share = share
+        self.on_progress = on_progress
+        self.deleted = 0
+
+    def run(self, remote_root):
+        self.submit(("dir", {"path": remote_root, "parent": None, "pending": 0}))
+        super().run()
+        return self.deleted
+
+    def process(self, conn, task):
+        if task[0] == "dir":
+            self._clear_dir(conn, task[1])
+        else:
+            node = task[1]
+            with METRICS.timer("deleteDirectory"):
+                conn.deleteDirectory(self.share, node["path"])
+            self._count(1)
+            if node["parent"]:
+                self._child_done(node["parent"])
+
+    def _clear_dir(self, conn, node):
+        path = node["path"]
+        with METRICS.timer("listPath"):
+            items = [i for i in conn.listPath(self.share, path) if i.filename not in ['.', '..']]
+        files = [i for i in items if not i.isDirectory]
+        subdirs = [i for i in items if i.isDirectory]
+
+        with self.cond:
+            # One for this folder's own files, one per subfolder
+            node["pending"] = len(subdirs) + 1
+        for item in subdirs:
+            self.submit(("dir", {"path": f"{path}/{item.filename}", "parent": node, "pending": 0}))
+
+        if files:
+            try:
+                # One server-side wildcard delete for every file in the folder
+                with METRICS.timer("deleteFiles", mode="wildcard"):
+                    conn.deleteFiles(self.share, f"{path}/*")
+            except Exception as e:
+                print(f"Wildcard delete in {path} failed, deleting one by one: {e}")
+                # It may have stopped partway, re-list so the file that really fails is the one reported
+                with METRICS.timer("listPath"):
+                    remaining = [i for i in conn.listPath(self.share, path) if not i.isDirectory]
+                for item in remaining:
+                    with METRICS.timer("deleteFiles"):
+                        conn.deleteFiles(self.share, f"{path}/{item.filename}")
+            self._count(len(files))
+        self._child_done(node)
+
+    def _child_done(self, node):
+        with self.cond:
+            node["pending"] -= 1
+            ready = node["pending"] == 0
+        if ready:
+            # Every child is confirmed gone, the folder itself can go now
+            self.submit(("rmdir", node))
+
+    def _count(self, n):
+        with self.cond:
+            self.deleted += n
+            deleted = self.deleted
+        if self.on_progress:
+            self.on_progress(deleted)
+
+
+class SearchIndex:
+    """ Local SQLite index of every file on a server's shares: path, size and last write time """
+
+    def __init__(self, config_dir, server):
+        digest = hashlib.sha1(server.encode('utf-8')).hexdigest()[:16]
+        self.server = server
+        self.db_file = os.path.join(config_dir, f"search_index_{digest}.db")
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_file, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                            "share TEXT, parent TEXT, name TEXT, size INTEGER, mtime REAL, is_dir INTEGER, "
+                            "PRIMARY KEY (share, parent, name))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_name ON files (name)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS dirs (share TEXT, path TEXT, mtime REAL, PRIMARY KEY (share, path))")
+
+    def dir_mtime(self, share, path):
+        with self.lock:
+            row = self.db.execute("SELECT mtime FROM dirs WHERE share=? AND path=?", (share, path)).fetchone()
+        return row[0] if row else None
+
+    def subdirs(self, share, path):
+        with self.lock:
+            rows = self.db.execute("SELECT name FROM files WHERE share=? AND parent=? AND is_dir=1", (share, path)).fetchall()
+        return [f"{path}/{r[0]}" if path else r[0] for r in rows]
+
+    def replace_dir(self, share, path, mtime, entries):
+        """ Store a fresh listing of one folder, dropping subtrees of folders that disappeared """
+        new_names = {f.filename for f in entries if f.isDirectory}
+        with self.lock, self.db:
+            for (name,) in self.db.execute("SELECT name FROM files WHERE share=? AND parent=? AND is_dir=1",
+                                           (share, path)).fetchall():
+                if name not in new_names:
+                    self._drop_subtree(share, f"{path}/{name}" if path else name)
+            self.db.execute("DELETE FROM files WHERE share=? AND parent=?", (share, path))
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                [(share, path, f.filename, f.file_size, f.last_write_time, int(f.isDirectory))
+                                 for f in entries])
+            self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (share, path, mtime))
+
+    def _drop_subtree(self, share, path):
+        like = path.replace('%', '\\%').replace('_', '\\_') + "/%"
+        self.db.execute("DELETE FROM files WHERE share=? AND (parent=? OR parent LIKE ? ESCAPE '\\')", (share, path, like))
+        self.db.execute("DELETE FROM dirs WHERE share=? AND (path=? OR path LIKE ? ESCAPE '\\')", (share, path, like))
+
+    def search(self, text, limit=500):
+        like = "%" + text.replace('%', '\\%').replace('_', '\\_') + "%"
+        with self.lock:
+            return self.db.execute("SELECT share, parent, name, size, mtime, is_dir FROM files "
+                                   "WHERE name LIKE ? ESCAPE '\\' ORDER BY mtime DESC LIMIT ?", (like, limit)).fetchall()
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+
+class SearchCrawler(PooledTaskRunner):
+    """ Refresh a SearchIndex, re-listing only folders whose last write time changed """
+
+    def __init__(self, conn, pool, index, max_workers=None):
+        super().__init__(conn, pool, max_workers)
+        self.index = index
+        self.listed = 0
+        self.skipped = 0
+
+    def run(self, shares):
+        for share in shares:
+            # Share roots have no parent entry to compare against, always list them
+            self.submit(("dir", share, "", None))
+        super().run()
+        return self.listed, self.skipped
+
+    def process(self, conn, task):
+        _, share, path, mtime = task
+        try:
+            known = self.index.dir_mtime(share, path)
+            if path and known is not None:
+                if mtime is None:
+                    # Cheap attribute query instead of transferring the whole listing
+                    mtime = conn.getAttributes(share, path).last_write_time
+                if mtime == known:
+                    # A folder's own entries are unchanged, but its subfolders may not be
+                    with self.cond:
+                        self.skipped += 1
+                    for sub in self.index.subdirs(share, path):
+                        self.submit(("dir", share, sub, None))
+                    return
+
+            with METRICS.timer("listPath", mode="index"):
+                entries = [f for f in conn.listPath(share, path) if f.filename not in ['.', '..']]
+            self.index.replace_dir(share, path, mtime, entries)
+            with self.cond:
+                self.listed += 1
+            for f in entries:
+                if f.isDirectory:
+                    self.submit(("dir", share, f"{path}/{f.filename}" if path else f.filename, f.last_write_time))
+        except (NotConnectedError, SMBTimeout, OSError):
+            raise
+        except Exception as e:
+            # Access denied and friends only cost us this folder
+            print(f"Index: skipping {share}/{path}: {e}")
+
+
+class SMBConnectionPool:
+    """ Bounded pool of SMB sessions sharing the same credentials """
+
+    def __init__(self, params, max_size=DEFAULT_TRANSFER_WORKERS, open_func=None):
+        self.params = dict(params)
+        self.max_size = max(1, int(max_size))
+        # Callers with their own connect fallbacks pass open_func instead of fixed params
+        self.open_func = open_func or (lambda: open_smb_connection(self.params))
+        self.closed = False
+        # (conn, released_at) of sessions ready for reuse
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+
+    def acquire(self, blocking=True):
+        # Blocks while max_size sessions are checked out
+        if not self._slots.acquire(blocking):
+            return None
+        while True:
+            try:
+                conn, released_at = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if time.monotonic() - released_at < POOL_PROBE_AFTER:
+                return conn
+            try:
+                conn.echo(b"ping", timeout=5)
+                return conn
+            except Exception as e:
+                print(f"Idle pooled session dropped, reconnecting: {e}")
+                self._close_conn(conn)
+        try:
+            return self.open_func()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def try_acquire(self):
+        """ Return a session only if one is free right now, otherwise None """
+        return self.acquire(blocking=False)
+
+    def release(self, conn, broken=False):
+        if broken or self.closed:
+            self._close_conn(conn)
+        else:
+            self._idle.put((conn, time.monotonic()))
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except (NotConnectedError, SMBTimeout, OSError):
+            # Session level failure, don't hand this connection out again
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def close_all(self):
+        self.closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close_conn(conn)
+
+    def _close_conn(self, conn):
+        try:
+            conn.close()
+        except Exception as e:
+            print(f"Failed to close pooled connection: {e}")
+
+
+class ListingCache:
+    """ LRU cache of share/folder listings with TTL, stale-while-revalidate and subfolder prefetch """
+
+    def __init__(self, get_pool, ttl=LISTING_TTL, stale_ttl=LISTING_STALE_TTL, max_entries=LISTING_CACHE_SIZE):
+        # Background work never touches the caller's connection, it borrows idle pooled sessions
+        self.get_pool = get_pool
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        # key -> callbacks waiting for its background refresh
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    @staticmethod
+    def _fetch(conn, share, path):
+        # share None stands for the share list itself
+        if share is None:
+            with METRICS.timer("listShares"):
+                return conn.listShares()
+        with METRICS.timer("listPath"):
+            return conn.listPath(share, path)
+
+    def get(self, conn, share, path="", force=False, on_refresh=None):
+        """ Return a listing, fetching on `conn` only if nothing usable is cached """
+        key = (share, path)
+        if not force:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry:
+                    self.entries.move_to_end(key)
+            if entry:
+                age = time.monotonic() - entry[0]
+                if age < self.ttl:
+                    return entry[1]
+                if age < self.stale_ttl:
+                    self._schedule(key, on_refresh)
+                    return entry[1]
+
+        listing = self._fetch(conn, share, path)
+        self.put(key, listing)
+        return listing
+
+    def put(self, key, listing):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), listing)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, share=None, path=None):
+        with self.lock:
+            if share is None and path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop((share, path or ""), None)
+
+    def prefetch(self, share, path, listing):
+        """ Warm the cache for the immediate subfolders of a listing that is on screen """
+        if share is None:
+            keys = [(s.name, "") for s in listing if not s.isSpecial and '$' not in s.name]
+        else:
+            keys = [(share, f"{path}/{f.filename}" if path else f.filename)
+                    for f in listing if f.isDirectory and f.filename not in ['.', '..']]
+        for key in keys[:LISTING_PREFETCH_DIRS]:
+            with self.lock:
+                entry = self.entries.get(key)
+            if not entry or time.monotonic() - entry[0] >= self.ttl:
+                self._schedule(key)
+
+    def _schedule(self, key, on_refresh=None):
+        with self.lock:
+            callbacks = self.in_flight.get(key)
+            first = callbacks is None
+            if first:
+                callbacks = self.in_flight[key] = []
+            if on_refresh:
+                # A refresh already running for this key reports to every caller that asked
+                callbacks.append(on_refresh)
+        if first:
+            self.executor.submit(self._refresh, key)
+
+    def _refresh(self, key):
+        listing = None
+        try:
+            pool = self.get_pool()
+            conn = pool.try_acquire() if pool else None
+            if conn is None:
+                # All sessions busy with transfers, try again on a later visit
+                return
+            broken = False
+            try:
+                listing = self._fetch(conn, *key)
+            except Exception as e:
+                print(f"Background listing of {key} failed: {e}")
+                broken = isinstance(e, (NotConnectedError, SMBTimeout, OSError))
+                return
+            finally:
+                pool.release(conn, broken)
+            self.put(key, listing)
+        finally:
+            with self.lock:
+                callbacks = self.in_flight.pop(key, [])
+        for on_refresh in callbacks:
+            on_refresh(listing)
+
+class PreviewCache:
+    """ Downloaded previews keyed by server/share/path/size/last write time, with an LRU byte budget """
+
+    def __init__(self, cache_dir, max_bytes, max_age_days=PREVIEW_CACHE_MAX_AGE_DAYS):
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400
+        self.lock = threading.Lock()
+        # Per-key locks so two threads opening the same file download it once
+        self.key_locks = {}
+        self.entries = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print(f"Failed to load preview cache index: {e}")
+                self.entries = {}
+        # Folders without an entry are left over from downloads interrupted by a crash
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name not in self.entries and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _save_locked(self):
+        try:
+            tmp_file = self.index_file + ".tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False)
+            os.replace(tmp_file, self.index_file)
+        except Exception as e:
+            print(f"Failed to save preview cache index: {e}")
+
+    @staticmethod
+    def make_key(server, share, path, size, mtime):
+        raw = f"{server}|{share}|{path}|{size}|{mtime}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:20]
+
+    def has(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return bool(entry) and os.path.exists(os.path.join(self.cache_dir, key, entry["file"]))
+
+    def get(self, key, filename, fetch):
+        """ Return a local path for `key`, calling fetch(path) to download only on a miss """
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            entry_dir = os.path.join(self.cache_dir, key)
+            local_path = os.path.join(entry_dir, filename)
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and os.path.exists(local_path) and os.path.getsize(local_path) == entry["bytes"]:
+                    entry["last_used"] = time.time()
+                    self._save_locked()
+                    return local_path, True
+
+            # Keep the original name so the viewer shows it, under a per-key folder
+            os.makedirs(entry_dir, exist_ok=True)
+            tmp_path = local_path + ".download"
+            try:
+                fetch(tmp_path)
+                os.replace(tmp_path, local_path)
+            except Exception:
+                # Drop the partial download too, it isn't under the byte budget until it is an entry
+                with self.lock:
+                    self.entries.pop(key, None)
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                raise
+
+            with self.lock:
+                now = time.time()
+                self.entries[key] = {"file": filename, "bytes": os.path.getsize(local_path), "created": now, "last_used": now}
+                self._evict_locked(keep=key)
+                self._save_locked()
+            return local_path, False
+
+    def _evict_locked(self, keep=None):
+        now = time.time()
+        expired = [k for k, e in self.entries.items() if k != keep and now - e["created"] > self.max_age]
+        by_age = sorted((k for k in self.entries if k != keep and k not in expired), key=lambda k: self.entries[k]["last_used"])
+        total = sum(e["bytes"] for k, e in self.entries.items() if k not in expired)
+        victims = list(expired)
+        for k in by_age:
+            if total <= self.max_bytes:
+                break
+            total -= self.entries[k]["bytes"]
+            victims.append(k)
+        for k in victims:
+            entry_dir = os.path.join(self.cache_dir, k)
+            try:
+                shutil.rmtree(entry_dir)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # Still open in a viewer on Windows, try again next time
+                print(f"Preview cache: cannot evict {entry_dir}: {e}")
+                continue
+            del self.entries[k]
+            self.key_locks.pop(k, None)
+
+def extract_exif_thumbnail(data):
+    """ Return the JPEG thumbnail embedded in the EXIF (APP1) segment of a JPEG header, if any """
+    if not data.startswith(b"\xff\xd8"):
+        return None
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker == 0xDA:
+            # Start of scan, no more metadata segments
+            break
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        segment = data[pos + 4:pos + 2 + length]
+        if marker == 0xE1 and segment.startswith(b"Exif"):
+            start = segment.find(b"\xff\xd8", 6)
+            end = segment.rfind(b"\xff\xd9")
+            if start >= 0 and end > start:
+                return segment[start:end + 2]
+        pos += 2 + length
+    return None
+
+
+def extract_pdf_jpeg(data):
+    """ Return the first DCTDecode (JPEG) image stream of a PDF, as scanners write one per page """
+    pos = data.find(b"/DCTDecode")
+    if pos < 0:
+        return None
+    start = data.find(b"\xff\xd8", pos)
+    if start < 0:
+        return None
+    end = data.find(b"endstream", start)
+    # A stream cut off by the header limit still decodes partially
+    return data[start:end] if end > 0 else data[start:]
+
+
+def render_thumbnail(data, size=THUMBNAIL_SIZE):
+    """ Decode image bytes and return a PNG thumbnail; runs in a worker process """
+    from PIL import Image, ImageFile
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    try:
+        img = Image.open(io.BytesIO(data))
+        # JPEG decoders can scale down while decoding, far cheaper than a full decode
+        img.draft("RGB", (size * 2, size * 2))
+        img = img.convert("RGB")
+        img.thumbnail((size, size))
+        out = io.BytesIO()
+        img.save(out, "PNG")
+        return out.getvalue()
+    except Exception as e:
+        print(f"Thumbnail decode failed: {e}")
+        return None
+
+
+class ThumbnailService:
+    """ Builds file list thumbnails in a process pool, cached on disk by path, size and last write time """
+
+    def __init__(self, cache_dir, get_pool, workers=2):
+        self.cache_dir = cache_dir
+        self.get_pool = get_pool
+        self.workers = workers
+        os.makedirs(cache_dir, exist_ok=True)
+        self.fetchers = ThreadPoolExecutor(max_workers=workers)
+        self.processes = None
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        # Anything queued for the folder we just left is dropped before it touches the network
+        with self.lock:
+            self.generation += 1
+
+    def request(self, key, share, path, remote_file, on_ready):
+        png_path = os.path.join(self.cache_dir, key + ".png")
+        if os.path.exists(png_path):
+            on_ready(png_path)
+            return
+        if os.path.exists(png_path + ".none"):
+            # Already tried, the format gave us nothing to show
+            return
+        self.fetchers.submit(self._build, self.generation, share, path, remote_file, png_path, on_ready)
+
+    def shutdown(self):
+        self.cancel()
+        self.fetchers.shutdown(wait=False, cancel_futures=True)
+        if self.processes:
+            self.processes.shutdown(wait=False, cancel_futures=True)
+
+    def _get_processes(self):
+        with self.lock:
+            if self.processes is None:
+                self.processes = ProcessPoolExecutor(max_workers=self.workers)
+            return self.processes
+
+    def _build(self, generation, share, path, remote_file, png_path, on_ready):
+        if generation != self.generation:
+            return
+        pool = self.get_pool()
+        if not pool:
+            return
+        try:
+            with pool.connection() as conn:
+                data = self._fetch(conn, share, path, remote_file)
+            if generation != self.generation:
+                return
+            png = self._get_processes().submit(render_thumbnail, data).result() if data else None
+            if not png:
+                open(png_path + ".none", 'wb').close()
+                return
+            tmp_path = png_path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, png_path)
+            if generation == self.generation:
+                on_ready(png_path)
+        except Exception as e:
+            print(f"Thumbnail for {path} failed: {e}")
+
+    def _read(self, conn, share, path, max_length=-1):
+        buf = io.BytesIO()
+        with METRICS.timer("retrieveFile", mode="thumbnail") as t:
+            _, t.bytes = conn.retrieveFileFromOffset(share, path, buf, offset=0, max_length=max_length)
+        return buf.getvalue()
+
+    def _fetch(self, conn, share, path, remote_file):
+        ext = os.path.splitext(path)[1].lower()
+        size = remote_file.file_size
+        if ext == ".pdf":
+            return extract_pdf_jpeg(self._read(conn, share, path, min(size, THUMBNAIL_PDF_HEADER_BYTES)))
+        if ext in (".jpg", ".jpeg"):
+            # Most cameras and MFPs embed a small EXIF thumbnail in the first few KB
+            header = self._read(conn, share, path, min(size, THUMBNAIL_HEADER_BYTES))
+            thumb = extract_exif_thumbnail(header)
+            if thumb or size <= len(header):
+                return thumb or header
+        # TIFF strips and PNG/BMP pixel data can sit anywhere, only small files are worth fetching whole
+        if size <= THUMBNAIL_MAX_FULL_FETCH:
+            return self._read(conn, share, path)
+        return None
+
+class ResolutionCache:
+    """ Persistent host->IP and IP->NetBIOS name cache, stale entries are served and refreshed in the background """
+
+    def __init__(self, config_dir):
+        self.cache_file = os.path.join(config_dir, RESOLVE_CACHE_NAME)
+        self.lock = threading.Lock()
+        # kind -> key -> {"value": str or None, "expires": epoch seconds}
+        self.entries = {"host": {}, "netbios": {}}
+        self.refreshing = set()
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                for kind in self.entries:
+                    self.entries[kind] = data.get(kind, {})
+            except Exception as e:
+                print(f"Failed to load resolve cache: {e}")
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries, ensure_ascii=False)
+        try:
+            tmp_path = self.cache_file + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.cache_file)
+        except Exception as e:
+            print(f"Failed to save resolve cache: {e}")
+
+    @staticmethod
+    def _lookup_host(host):
+        try:
+            socket.inet_aton(host)
+            return host
+        except socket.error:
+            pass
+        with METRICS.timer("dns"):
+            return socket.gethostbyname(host)
+
+    @staticmethod
+    def _lookup_netbios(ip):
+        # Only needed for the port 139 fallback, so nmb is loaded on first use
+        from nmb.NetBIOS import NetBIOS
+        nb = NetBIOS()
+        try:
+            with METRICS.timer("netbios"):
+                resolved = nb.queryIPForName(ip, port=137, timeout=2)
+        finally:
+            nb.close()
+        return resolved[0] if resolved else None
+
+    def _store(self, kind, key, value):
+        ttl = NEGATIVE_TTL if value is None else (DNS_TTL if kind == "host" else NETBIOS_TTL)
+        with self.lock:
+            self.entries[kind][key] = {"value": value, "expires": time.time() + ttl}
+        self.save()
+
+    def _resolve(self, kind, key):
+        lookup = self._lookup_host if kind == "host" else self._lookup_netbios
+        try:
+            value = lookup(key)
+        except Exception as e:
+            print(f"{kind} lookup for {key} failed: {e}")
+            value = None
+        self._store(kind, key, value)
+        return value
+
+    def _refresh(self, kind, key):
+        try:
+            self._resolve(kind, key)
+        finally:
+            with self.lock:
+                self.refreshing.discard((kind, key))
+
+    def refresh_async(self, kind, key):
+        with self.lock:
+            if (kind, key) in self.refreshing:
+                return
+            self.refreshing.add((kind, key))
+        threading.Thread(target=self._refresh, args=(kind, key), daemon=True).start()
+
+    def get(self, kind, key):
+        """ Cached value (None for a known failure), looked up synchronously only on a cold miss """
+        with self.lock:
+            entry = self.entries[kind].get(key)
+        if entry is None:
+            return self._resolve(kind, key)
+        if entry["expires"] < time.time():
+            self.refresh_async(kind, key)
+        return entry["value"]
+
+    def resolve_host(self, host):
+        return self.get("host", host)
+
+    def netbios_name(self, ip):
+        return self.get("netbios", ip)
+
+    def cached(self, kind, key):
+        """ (hit, value) without ever blocking on a lookup """
+        with self.lock:
+            entry = self.entries[kind].get(key)
+        if entry is None:
+            return False, None
+        if entry["expires"] < time.time():
+            self.refresh_async(kind, key)
+        return True, entry["value"]
+
+    def warm(self, host):
+        """ Refresh the configured server in the background so startup doesn't wait on it """
+        if not host:
+            return
+        def run():
+            ip = self.resolve_host(host) or host
+            self.netbios_name(ip)
+        threading.Thread(target=run, daemon=True).start()
+
+
+class ContentIndex:
+    """ Local SQLite map of content digest -> downloaded files, used to avoid storing the same scan twice """
+
+    COLUMNS = ["path", "digest", "size", "stored_size", "mtime", "derived"]
+
+    def __init__(self, config_dir):
+        self.db_file = os.path.join(config_dir, CONTENT_INDEX_NAME)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_file, check_same_thread=False)
+        with self.lock, self.db:
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(content)")]
+            if columns and columns != self.COLUMNS:
+                # Only a cache of what is on disk, an older layout is simply rebuilt
+                self.db.execute("DROP TABLE content")
+            # digest/size describe the downloaded bytes; stored_size/mtime the file now at `path`,
+            # which is `derived` when post-processing changed its content
+            self.db.execute("CREATE TABLE IF NOT EXISTS content (path TEXT PRIMARY KEY, digest TEXT, size INTEGER, "
+                            "stored_size INTEGER, mtime REAL, derived INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS content_digest ON content (digest)")
+
+    def add(self, path, digest, size, derived=False):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO content VALUES (?, ?, ?, ?, ?, ?)",
+                            (path, digest, size, st.st_size, st.st_mtime, int(derived)))
+
+    def _drop(self, path):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM content WHERE path=?", (path,))
+
+    def find(self, digest, size, exclude=None):
+        """ (path, derived) of an existing local copy of this content; entries whose file changed are dropped """
+        exclude = os.path.abspath(exclude) if exclude else None
+        with self.lock:
+            rows = self.db.execute("SELECT path, stored_size, mtime, derived FROM content WHERE digest=? AND size=?",
+                                   (digest, size)).fetchall()
+        for path, stored_size, mtime, derived in rows:
+            if path == exclude:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                self._drop(path)
+                continue
+            if st.st_size != stored_size:
+                self._drop(path)
+                continue
+            if st.st_mtime != mtime:
+                # Touched since it was indexed, only trust it if the bytes still match
+                if derived or hash_file(path, hashlib.new(CONTENT_HASH)).hexdigest() != digest:
+                    self._drop(path)
+                    continue
+                self.add(path, digest, size)
+            return path, bool(derived)
+        return None, False
+
+    def processed(self, old_path, new_path):
+        """ Follow a file through post-processing, so later duplicates still find it """
+        old_path = os.path.abspath(old_path)
+        with self.lock:
+            row = self.db.execute("SELECT digest, size FROM content WHERE path=?", (old_path,)).fetchone()
+        if not row or not new_path:
+            return
+        digest, size = row
+        try:
+            derived = os.path.getsize(new_path) != size or \
+                hash_file(new_path, hashlib.new(CONTENT_HASH)).hexdigest() != digest
+            self.add(new_path, digest, size, derived)
+        except OSError as e:
+            print(f"Failed to index {new_path}: {e}")
+        if os.path.abspath(new_path) != old_path:
+            self._drop(old_path)
+
+    def dedup(self, path, digest, size, mode):
+        """ Record a verified download; returns where its content now lives (the existing copy for "skip") """
+        existing, derived = self.find(digest, size, path) if mode in ("hardlink", "skip") else (None, False)
+        if existing is None:
+            self.add(path, digest, size)
+            return path
+
+        METRICS.inc("dedup_hits_total", mode=mode)
+        METRICS.inc("dedup_bytes_saved_total", size)
+        if mode == "skip":
+            os.remove(path)
+            print(f"Duplicate of {existing}, not stored again: {path}")
+            return existing
+        if derived:
+            # The existing copy was converted, linking would put different content under this name
+            print(f"Duplicate of processed file {existing}, keeping copy: {path}")
+            self.add(path, digest, size)
+            return path
+        try:
+            tmp_path = path + ".link"
+            os.link(existing, tmp_path)
+            os.replace(tmp_path, path)
+            print(f"Duplicate of {existing}, hard-linked: {path}")
+        except OSError as e:
+            # Other volume or no hard link support, keep the separate copy
+            print(f"Hard link to {existing} failed, keeping copy: {e}")
+        self.add(path, digest, size)
+        return path
+
+
+class DirectorySnapshot:
+    """ Last seen state of a watched folder, so each cycle only handles what changed """
+
+    def __init__(self, config_dir, source_key):
+        digest = hashlib.sha1(source_key.encode('utf-8')).hexdigest()[:16]
+        self.snapshot_file = os.path.join(config_dir, f"snapshot_{digest}.json")
+        self.source_key = source_key
+        # filename -> [size, last_write_time, file_id]
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.snapshot_file):
+            try:
+                with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f).get("entries", {})
+            except Exception as e:
+                print(f"Failed to load snapshot: {e}")
+                self.entries = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            with open(self.snapshot_file, 'w', encoding='utf-8') as f:
+                json.dump({"source": self.source_key, "entries": self.entries}, f, ensure_ascii=False)
+            self.dirty = False
+        except Exception as e:
+            print(f"Failed to save snapshot: {e}")
+
+    @staticmethod
+    def entry_key(f):
+        return [f.file_size, f.last_write_time, getattr(f, 'file_id', None) or 0]
+
+    def diff(self, files):
+        """ Split a listing into (added, changed, removed) against the snapshot """
+        added = []
+        changed = []
+        seen = set()
+        for f in files:
+            if f.filename in ['.', '..'] or f.isDirectory:
+                continue
+            seen.add(f.filename)
+            old = self.entries.get(f.filename)
+            if old is None:
+                added.append(f)
+            elif old != self.entry_key(f):
+                changed.append(f)
+        removed = [name for name in self.entries if name not in seen]
+        return added, changed, removed
+
+    def commit(self, f):
+        # Only called once a file was handled, failed downloads show up again next cycle
+        self.entries[f.filename] = self.entry_key(f)
+        self.dirty = True
+
+    def forget(self, names):
+        for name in names:
+            if self.entries.pop(name, None) is not None:
+                self.dirty = True
+
+class DownloadHistory:
+    """ Download records kept as date -> set in memory over an append-only JSON-lines journal """
+
+    FLUSH_BATCH = 20         # pending records before a forced write
+    FLUSH_INTERVAL = 5.0     # seconds a record may stay buffered
+    COMPACT_MIN_LINES = 200  # don't bother compacting tiny journals
+
+    def __init__(self, config_dir, days_to_keep=30):
+        self.history_file = os.path.join(config_dir, "download_history.jsonl")
+        self.legacy_file = os.path.join(config_dir, "download_history.json")
+        self.days_to_keep = days_to_keep
+        self.history = {}
+        self.journal_lines = 0
+        self.pending = []
+        self.first_pending_at = 0.0
+        self.cleaned_on = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        with self.lock:
+            self.history = {}
+            self.journal_lines = 0
+            if os.path.exists(self.history_file):
+                try:
+                    with open(self.history_file, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            line = line.strip()
+                            if not line:
+                                continue
+                            self.journal_lines += 1
+                            try:
+                                rec = json.loads(line)
+                            except ValueError:
+                                # Torn last line after a crash, skip it
+                                continue
+                            self.history.setdefault(rec["d"], set()).add(rec["f"])
+                except Exception as e:
+                    print(f"Failed to load history: {e}")
+                    self.history = {}
+            elif os.path.exists(self.legacy_file):
+                self._migrate_legacy()
+
+            self._clean_locked()
+
+    def _migrate_legacy(self):
+        # One-time import of the old {date: [names]} JSON file
+        try:
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+            for day, names in legacy.items():
+                self.history.setdefault(day, set()).update(names)
+            self._compact_locked()
+            os.replace(self.legacy_file, self.legacy_file + ".migrated")
+            print(f"Migrated {sum(len(v) for v in legacy.values())} history records to {self.history_file}")
+        except Exception as e:
+            print(f"Failed to migrate history: {e}")
+
+    def save(self):
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self.pending:
+            return
+        try:
+            with open(self.history_file, 'a', encoding='utf-8') as f:
+                f.write("".join(self.pending))
+            self.journal_lines += len(self.pending)
+            self.pending = []
+        except Exception as e:
+            print(f"Failed to save history: {e}")
+            return
+
+        live = sum(len(v) for v in self.history.values())
+        if self.journal_lines > max(self.COMPACT_MIN_LINES, live * 2):
+            self._compact_locked()
+
+    def _compact_locked(self):
+        # Rewrite the journal with only live records, atomically
+        tmp_file = self.history_file + ".tmp"
+        try:
+            lines = [json.dumps({"d": day, "f": name}, ensure_ascii=False) + "\n"
+                     for day in sorted(self.history) for name in sorted(self.history[day])]
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write("".join(lines))
+            os.replace(tmp_file, self.history_file)
+            self.journal_lines = len(lines)
+        except Exception as e:
+            print(f"Failed to compact history: {e}")
+
+    def get_today_key(self):
+        return datetime.date.today().isoformat()
+
+    def is_downloaded(self, filename):
+        today = self.get_today_key()
+        names = self.history.get(today, ())
+        # Records migrated from the old history file only carry the bare file name
+        return filename in names or filename.rsplit("/", 1)[-1] in names
+
+    def add_record(self, filename):
+        today = self.get_today_key()
+        with self.lock:
+            if self.cleaned_on != today:
+                self._clean_locked()
+            names = self.history.setdefault(today, set())
+            if filename in names:
+                return
+            names.add(filename)
+            if not self.pending:
+                self.first_pending_at = time.monotonic()
+            self.pending.append(json.dumps({"d": today, "f": filename}, ensure_ascii=False) + "\n")
+            if len(self.pending) >= self.FLUSH_BATCH or time.monotonic() - self.first_pending_at >= self.FLUSH_INTERVAL:
+                self._flush_locked()
+
+    def clean_old_records(self, days_to_keep=None):
+        with self.lock:
+            if days_to_keep is not None:
+                self.days_to_keep = days_to_keep
+            self._clean_locked()
+
+    def _clean_locked(self):
+        # Drop days outside the retention window; the journal shrinks on the next compaction
+        self.cleaned_on = self.get_today_key()
+        cutoff = (datetime.date.today() - datetime.timedelta(days=self.days_to_keep)).isoformat()
+        expired = [day for day in self.history if day < cutoff]
+        for day in expired:
+            del self.history[day]
+        if expired:
+            self._flush_locked()
+            self._compact_locked()
+
+
+# Post-download stages run in worker processes: plain functions taking (path, options, context)
+# and returning the file's new path. Register extra ones with @post_stage("name").
+POST_STAGES = {}
+
+
+def post_stage(name):
+    def register(func):
+        POST_STAGES[name] = func
+        return func
+    return register
+
+
+def unique_path(path):
+    base, ext = os.path.splitext(path)
+    n = 1
+    while os.path.exists(path):
+        path = f"{base}_{n}{ext}"
+        n += 1
+    return path
+
+
+@post_stage("recompress")
+def stage_recompress(path, options, context):
+    """ Re-encode JPEG/PNG with Pillow, the original is only replaced when the result is smaller """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in (".jpg", ".jpeg", ".png"):
+        return path
+    from PIL import Image
+    tmp_path = path + ".recompress"
+    with Image.open(path) as img:
+        if ext == ".png":
+            img.save(tmp_path, "PNG", optimize=True)
+        else:
+            img.save(tmp_path, "JPEG", quality=int(options.get("quality", 80)), optimize=True,
+                     progressive=True, exif=img.info.get("exif", b""), dpi=img.info.get("dpi", (200, 200)))
+    if os.path.getsize(tmp_path) < os.path.getsize(path):
+        os.replace(tmp_path, path)
+    else:
+        os.remove(tmp_path)
+    return path
+
+
+@post_stage("tiff_to_pdf")
+def stage_tiff_to_pdf(path, options, context):
+    """ Multi-page TIFF scans become one PDF next to it """
+    if os.path.splitext(path)[1].lower() not in (".tif", ".tiff"):
+        return path
+    from PIL import Image, ImageSequence
+    pdf_path = unique_path(os.path.splitext(path)[0] + ".pdf")
+    with Image.open(path) as img:
+        dpi = img.info.get("dpi", (200, 200))[0]
+        pages = [page.convert("RGB") if page.mode not in ("1", "L", "RGB") else page.copy()
+                 for page in ImageSequence.Iterator(img)]
+    pages[0].save(pdf_path, "PDF", save_all=True, append_images=pages[1:], resolution=float(dpi))
+    if not options.get("keep_original", False):
+        os.remove(path)
+    return pdf_path
+
+
+@post_stage("date_rename")
+def stage_date_rename(path, options, context):
+    """ Rename by the scan's timestamp and move into a dated subfolder of the download folder """
+    stamp = datetime.datetime.fromtimestamp(context.get("mtime") or os.path.getmtime(path))
+    folder, name = os.path.split(path)
+    base, ext = os.path.splitext(name)
+    new_name = stamp.strftime(options.get("name", "%Y%m%d_%H%M%S_{name}")).replace("{name}", base) + ext
+    target_dir = os.path.join(folder, stamp.strftime(options.get("folder", "%Y-%m-%d")))
+    os.makedirs(target_dir, exist_ok=True)
+    target = unique_path(os.path.join(target_dir, new_name))
+    os.replace(path, target)
+    return target
+
+
+def run_post_stages(path, stages, context):
+    """ Worker process entry, applies the stages in order and returns the final path """
+    for spec in stages:
+        stage = POST_STAGES.get(spec.get("stage"))
+        if stage is None:
+            raise ValueError(f"未知的处理步骤: {spec.get('stage')}")
+        path = stage(path, spec, context)
+    return path
+
+
+class PostProcessor:
+    """ Bounded process pool for post-download stages; submit() blocks while too many files are queued """
+
+    def __init__(self, get_workers=lambda: DEFAULT_POST_WORKERS, max_pending=POST_MAX_PENDING):
+        # Read when the pool is first needed, the owner's config may not be loaded yet
+        self.get_workers = get_workers
+        self.pool = None
+        self.lock = threading.Lock()
+        # Back-pressure: the downloading thread waits here instead of queueing unbounded work
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.get_workers())
+            return self.pool
+
+    def submit(self, path, stages, context=None, on_done=None):
+        if not stages:
+            return
+        self.slots.acquire()
+        try:
+            future = self._get_pool().submit(run_post_stages, path, stages, context or {})
+        except Exception:
+            self.slots.release()
+            raise
+        start = time.perf_counter()
+
+        def done(fut):
+            self.slots.release()
+            METRICS.observe("post_process_seconds", time.perf_counter() - start, METRICS.DURATION_BUCKETS)
+            try:
+                result = fut.result()
+                print(f"Post-processed {os.path.basename(path)} -> {result}")
+            except Exception as e:
+                METRICS.inc("post_process_errors_total")
+                print(f"Post-processing {path} failed: {e}")
+                result = None
+            if on_done:
+                on_done(path, result)
+
+        future.add_done_callback(done)
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            pool.shutdown(wait=wait)
+
+
+def load_config_file(config_file):
+    try:
+        if os.path.exists(config_file):
+            with open(config_file, 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"Failed to load config: {e}")
+    return {}
+
+
+def get_write_buffer(config):
+    try:
+        return max(64, int(config.get("write_buffer_kb", DEFAULT_WRITE_BUFFER_KB))) * 1024
+    except (TypeError, ValueError):
+        return DEFAULT_WRITE_BUFFER_KB * 1024
+
+
+def watch_jobs_from_config(config):
+    """ Configured watch jobs with defaults filled in, a pre-job-list config becomes a single job """
+    jobs = config.get("watch_jobs")
+    if jobs is None:
+        src_path = config.get("auto_source_path", "").strip()
+        local_path = config.get("auto_local_path", "").strip()
+        jobs = []
+        if src_path and local_path:
+            jobs.append({"name": "默认", "source_path": src_path, "local_path": local_path,
+                         "interval": config.get("check_interval", 60)})
+    return [dict(WATCH_JOB_DEFAULTS, **job) for job in jobs]
+
+
+def parse_active_hours(text):
+    """ "08:00-12:00, 13:00-18:30" -> [(480, 720), (780, 1110)] in minutes, ranges may wrap past midnight """
+    ranges = []
+    for part in (text or "").replace("，", ",").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            start, end = (datetime.datetime.strptime(x.strip(), "%H:%M") for x in part.split("-"))
+            ranges.append((start.hour * 60 + start.minute, end.hour * 60 + end.minute))
+        except ValueError:
+            print(f"Ignoring invalid active hours '{part}'")
+    return ranges
+
+
+def seconds_until_active(ranges, now=None):
+    """ 0 inside an active range (or when no ranges are set), otherwise seconds until the next one starts """
+    if not ranges:
+        return 0
+    now = now or datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+    waits = []
+    for start, end in ranges:
+        inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+        if inside:
+            return 0
+        waits.append((start - minute) % (24 * 60))
+    return min(waits) * 60 - now.second
+
+
+class AutomationEngine:
+    """ Watch-folder scheduler: jobs run concurrently on a session pool per server, transfers capped globally """
+
+    def __init__(self, config_dir, get_config, resolver=None):
+        self.config_dir = config_dir
+        # Called on every scheduler tick, so settings changes are picked up without a restart
+        self.get_config = get_config
+        self.resolver = resolver or ResolutionCache(config_dir)
+        self.history = DownloadHistory(config_dir)
+        # host -> (connection settings, SMBConnectionPool); a session serves one listing or transfer at a time,
+        # so jobs on the same server interleave instead of waiting for each other's whole cycle
+        self.servers = {}
+        self.servers_lock = threading.Lock()
+        # job key -> {"next_run", "running", "snapshot"}
+        self.jobs = {}
+        self.transfer_limit = 0
+        self.transfer_slots = None
+        self.post_processor = PostProcessor(self.get_post_workers)
+        self.content_index = ContentIndex(config_dir)
+        self.stop_event = threading.Event()
+
+    def get_post_workers(self):
+        try:
+            return max(1, int(self.get_config().get("post_process_workers", DEFAULT_POST_WORKERS)))
+        except (TypeError, ValueError):
+            return DEFAULT_POST_WORKERS
+
+    def open_connection(self, host):
+        config = self.get_config()
+        ip = (self.resolver.resolve_host(host) if host else None) or host
+        client_name = socket.gethostname().split('.')[0][:15]
+        params = {
+            "ip": ip,
+            "port": int(config.get("port", 445)),
+            "remote_name": self.resolver.cached("netbios", ip)[1] or host or "*SMBSERVER", # Remote name guess
+            "client_name": client_name,
+            "user": config.get("user", "guest"),
+            "password": config.get("password", "")
+        }
+        # Prefer whatever the interactive connect() last settled on for this host
+        hint = config.get("connect_hints", {}).get(host)
+        if hint:
+            params.update(port=hint["port"], remote_name=hint["remote_name"])
+        try:
+            return open_smb_connection(params, timeout=10)
+        except Exception as e:
+            print(f"Auto-download: port {params['port']} failed: {e}")
+
+        # Fallback port 139 needs a NetBIOS session name
+        params.update(port=139, remote_name="*SMBSERVER")
+        return open_smb_connection(params, timeout=10)
+
+    def get_pool(self, config, host):
+        settings = (config.get("port", 445), config.get("user", "guest"), config.get("password", ""), self.transfer_limit)
+        with self.servers_lock:
+            server = self.servers.get(host)
+            if server and server[0] == settings:
+                return server[1]
+            # Credentials or the transfer limit changed; sessions still checked out are closed when released
+            pool = SMBConnectionPool({}, self.transfer_limit, lambda: self.open_connection(host))
+            self.servers[host] = (settings, pool)
+        if server:
+            server[1].close_all()
+        return pool
+
+    def close_sessions(self):
+        with self.servers_lock:
+            servers = list(self.servers.values())
+            self.servers = {}
+        for _, pool in servers:
+            pool.close_all()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        self.close_sessions()
+        self.history.flush()
+        self.post_processor.shutdown()
+
+    def update_transfer_limit(self, config):
+        try:
+            limit = max(1, int(config.get("auto_max_transfers", DEFAULT_AUTO_MAX_TRANSFERS)))
+        except (TypeError, ValueError):
+            limit = DEFAULT_AUTO_MAX_TRANSFERS
+        if limit != self.transfer_limit:
+            # Transfers holding the old semaphore finish against it, new ones use the new limit
+            self.transfer_limit = limit
+            self.transfer_slots = threading.BoundedSemaphore(limit)
+
+    def run(self):
+        executor = ThreadPoolExecutor(max_workers=MAX_WATCH_JOBS)
+        try:
+            while not self.stop_event.is_set():
+                wake = time.monotonic() + SCHEDULER_TICK
+                try:
+                    wake = min(wake, self.schedule(executor))
+                except Exception as e:
+                    print(f"Auto-download scheduler error: {e}")
+                self.stop_event.wait(max(wake - time.monotonic(), 0.1))
+        finally:
+            executor.shutdown(wait=True)
+
+    def schedule(self, executor):
+        """ Start every due job that isn't already running, returns when the next one is due """
+        # One consistent view of the settings for this tick
+        config = dict(self.get_config())
+        if not config.get("auto_download_enabled", False):
+            self.close_sessions()
+            return float("inf")
+        self.update_transfer_limit(config)
+
+        now = time.monotonic()
+        next_due = float("inf")
+        for job in watch_jobs_from_config(config):
+            host = job["server"] or config.get("ip", "")
+            if not job["enabled"] or not job["source_path"] or not job["local_path"] or not host:
+                continue
+            # Same key as the job's snapshot, so renaming a job keeps its state
+            key = f"{host}/{job['source_path']} -> {job['local_path']}"
+            state = self.jobs.setdefault(key, {"next_run": now, "running": False, "snapshot": None})
+            if state["running"]:
+                continue
+            if state["next_run"] <= now:
+                state["running"] = True
+                executor.submit(self.run_job, config, job, host, key, state)
+            else:
+                next_due = min(next_due, state["next_run"])
+        return next_due
+
+    def run_job(self, config, job, host, key, state):
+        found = 0
+        try:
+            with METRICS.timer("automation_cycle", job=job["name"]):
+                found = self.run_cycle(config, job, self.get_pool(config, host), key, state)
+        except Exception as e:
+            # The pool already dropped a session that failed at the transport level
+            print(f"Auto-download error ({job['name']}): {e}")
+            if isinstance(e, (NotConnectedError, SMBTimeout, OSError)):
+                METRICS.inc("automation_connect_failures_total")
+        finally:
+            try:
+                state["next_run"] = time.monotonic() + self.next_delay(config, job, state, found)
+            finally:
+                # Cleared even if the delay can't be computed, or the job would never run again
+                state["running"] = False
+
+    def next_delay(self, config, job, state, found):
+        """ Seconds until the job's next poll """
+        try:
+            interval = max(5, int(job["interval"] or 60)) # Safety minimum
+        except (TypeError, ValueError):
+            interval = 60
+        if not config.get("adaptive_polling", True):
+            return interval
+        try:
+            lo = max(5, int(config.get("poll_min_interval", DEFAULT_POLL_MIN_INTERVAL)))
+            hi = max(lo, int(config.get("poll_max_interval", DEFAULT_POLL_MAX_INTERVAL)))
+        except (TypeError, ValueError):
+            lo, hi = DEFAULT_POLL_MIN_INTERVAL, DEFAULT_POLL_MAX_INTERVAL
+
+        # The job interval seeds the backoff, idle jobs slow down to poll_max_interval;
+        # a job configured slower than that keeps its own interval as the ceiling
+        hi = max(hi, interval)
+        wait = seconds_until_active(parse_active_hours(config.get("active_hours", "")))
+        if wait:
+            # Outside active hours: slowest rate, but be fast again as soon as the window opens
+            state["delay"] = lo
+            return max(5, min(hi, wait))
+
+        if found:
+            delay = lo
+        else:
+            delay = min(hi, max(lo, state.get("delay", interval) * 2))
+        state["delay"] = delay
+        METRICS.observe("automation_poll_interval_seconds", delay, METRICS.DURATION_BUCKETS + (120, 300, 600, 1800), job=job["name"])
+        return delay
+
+    def run_cycle(self, config, job, pool, key, state):
+        src_path = job["source_path"]
+        local_path = job["local_path"]
+        # src_path format: "ShareName/Folder/Subfolder"
+        parts = src_path.replace('\\', '/').split('/', 1)
+        share = parts[0]
+        rel_path = parts[1] if len(parts) > 1 else ""
+
+        with pool.connection() as conn, METRICS.timer("listPath", mode="auto"):
+            files = conn.listPath(share, rel_path)
+
+        # Only new or modified files go to the download step
+        if state["snapshot"] is None:
+            state["snapshot"] = DirectorySnapshot(self.config_dir, key)
+        snapshot = state["snapshot"]
+        added, changed, removed = snapshot.diff(files)
+        snapshot.forget(removed)
+        ready, waiting = self.settle(config, state, added + changed)
+        if ready or removed:
+            print(f"Auto-download ({job['name']}): {len(added)} added, {len(changed)} changed, {len(removed)} removed, "
+                  f"{len(waiting)} still being written")
+
+        try:
+            for f in ready:
+                if self.stop_event.is_set():
+                    break
+                # History is per source folder, scanners often reuse the same file names
+                record = f"{src_path}/{f.filename}"
+                if config.get("skip_downloaded_today", True):
+                    if self.history.is_downloaded(record):
+                        snapshot.commit(f)
+                        continue
+
+                # Download
+                if not os.path.exists(local_path):
+                    os.makedirs(local_path)
+
+                file_path = os.path.join(local_path, f.filename)
+                remote_file_path = os.path.join(rel_path, f.filename).replace('\\', '/')
+
+                # Global slot first, then a session: a listing never waits for a slot, so this can't deadlock
+                with self.transfer_slots, pool.connection() as conn:
+                    # Raises on a short or oversized transfer, so nothing below runs for a bad copy
+                    digest = retrieve_file_resumable(conn, share, remote_file_path, file_path, f,
+                                                     buffer_size=get_write_buffer(config))
+                METRICS.inc("automation_files_total", job=job["name"])
+                stored_path = self.content_index.dedup(file_path, digest, f.file_size, config.get("dedup_mode", "off"))
+
+                # Mark history
+                self.history.add_record(record)
+                snapshot.commit(f)
+
+                # A job may override the global post-processing steps; skipped duplicates were processed already
+                stages = job.get("post_process")
+                if stages is None:
+                    stages = config.get("post_process", [])
+                if stored_path == file_path:
+                    self.post_processor.submit(file_path, stages, {"mtime": f.last_write_time, "job": job["name"]},
+                                               self.content_index.processed)
+
+                # Delete if enabled, only ever after a size-verified download
+                if config.get("delete_after_download", False) and digest:
+                    with pool.connection() as conn, METRICS.timer("deleteFiles", mode="auto"):
+                        conn.deleteFiles(share, remote_file_path)
+                    print(f"Auto-download ({job['name']}): Downloaded & Deleted {f.filename}")
+                else:
+                    print(f"Auto-download ({job['name']}): Downloaded {f.filename}")
+        finally:
+            snapshot.save()
+            self.history.flush()
+
+        # Unsettled files count as activity so the job polls again soon
+        return len(ready) + len(waiting)
+
+    def settle(self, config, state, candidates):
+        """ Split new/changed files into (ready, waiting) using the listing's size and last-write time """
+        try:
+            needed = max(1, int(config.get("settle_observations", DEFAULT_SETTLE_OBSERVATIONS)))
+        except (TypeError, ValueError):
+            needed = DEFAULT_SETTLE_OBSERVATIONS
+        # filename -> [size, last_write_time, times seen unchanged]
+        seen = state.setdefault("settling", {})
+        ready = []
+        waiting = []
+        current = {}
+        for f in candidates:
+            entry = seen.get(f.filename)
+            if entry and entry[0] == f.file_size and entry[1] == f.last_write_time:
+                entry[2] += 1
+            else:
+                # New, or still growing: start counting again
+                entry = [f.file_size, f.last_write_time, 1]
+            (ready if entry[2] >= needed else waiting).append(f)
+            current[f.filename] = entry
+        if waiting:
+            METRICS.inc("automation_unsettled_total", len(waiting))
+        # Handled files drop out of the candidates and so stop being tracked; a failed download stays settled
+        state["settling"] = current
+        return ready, waiting
+
+
+def start_metrics_exporter(config, config_dir):
+    try:
+        port = int(config.get("metrics_port", 0))
+    except (TypeError, ValueError):
+        port = 0
+    exporter = MetricsExporter(METRICS, os.path.join(config_dir, METRICS_FILE_NAME), port)
+    exporter.start()
+    return exporter
+
+
+def run_daemon(argv=None):
+    """ Headless watcher entry point, `main.py --headless` or `python smb_core.py` """
+    parser = argparse.ArgumentParser(description="Headless auto-download service")
+    parser.add_argument("--headless", "--daemon", action="store_true", help="run without the GUI (default here)")
+    parser.add_argument("--config", default=os.path.join(CONFIG_DIR, CONFIG_FILE_NAME), help="path to config.json")
+    args = parser.parse_args(argv)
+
+    config_file = os.path.abspath(args.config)
+    config_dir = os.path.dirname(config_file)
+    os.makedirs(config_dir, exist_ok=True)
+    state = {"config": load_config_file(config_file), "mtime": None}
+    state_lock = threading.Lock()
+
+    def get_config():
+        # Re-read config.json when the desktop client (or an admin) changed it
+        try:
+            mtime = os.path.getmtime(config_file)
+        except OSError:
+            mtime = None
+        with state_lock:
+            if mtime != state["mtime"]:
+                state["mtime"] = mtime
+                state["config"] = load_config_file(config_file)
+            return state["config"]
+
+    config = get_config()
+    if not config.get("auto_download_enabled", False):
+        print(f"Auto-download is disabled in {config_file}, waiting for it to be enabled")
+
+    engine = AutomationEngine(config_dir, get_config)
+    exporter = start_metrics_exporter(config, config_dir)
+
+    def on_signal(signum, frame):
+        print(f"Received signal {signum}, stopping after the current file")
+        engine.stop()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    print(f"Watching {len(watch_jobs_from_config(config))} job(s) from {config_file}")
+    try:
+        engine.run()
+    finally:
+        engine.close()
+        exporter.write()
+    print("Stopped")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run_daemon())